@@ -32,10 +32,14 @@ Authors: Damion Dooley, Nithu Sara John
 Centre for Infectious Disease Epidemiology and One Health
 August 24, 2021
 
-Requires Biopython and Requests modules
-- "pip install biopython" or https://biopython.org/wiki/Download
+Requires Pandas and Requests modules
+- "pip install pandas"
 - "pip install requests"
 
+Optionally uses the Requests-toolbelt module to stream uploads from disk
+rather than loading whole batch files into memory
+- "pip install requests-toolbelt"
+
 Usage:
 python fasta_uploader.py -m "samples_xyz.csv" -f "samples_xyz.fasta" -k "fasta header name" -d -a VirusSeq_Portal -u eyJhbGciOiJSUz....ykapL1A
 
@@ -44,14 +48,24 @@ them so after error correction in batch files they can be merged into one
 corrected file?
 """
 
-from Bio import SeqIO
-import numpy as np
+import concurrent.futures
+import mmap
+import multiprocessing
 import optparse
 import pandas as pd
+import pickle
 import sys
 import requests
-import os, glob
+import os
+import time
 from datetime import datetime
+from operator import itemgetter
+from urllib3.util.retry import Retry
+
+try:
+   from requests_toolbelt import MultipartEncoder
+except ImportError:  # Optional; uploads fall back to in-memory multipart.
+   MultipartEncoder = None
 
 
 # init_parser()
@@ -73,6 +87,8 @@ def init_parser():
       help="Provide an output file name/path.", default='output');
    parser.add_option('-k', '--key', dest="key_field",
       help="Provide the metadata field name to match to fasta record identifier.");
+   parser.add_option('-j', '--jobs', dest="jobs", default=0,
+      help="Provide number of worker processes for batch file generation.  Defaults to the cpu count.");
    parser.add_option('-n', '--number', dest="batch_number", default = False,
       help="Process only given batch number to API instead of all batches.");
    # API related parameters
@@ -88,16 +104,23 @@ def init_parser():
    parser.add_option('-r', '--reset', dest="reset", action='store_true', 
       help="Regenerate all batch files and begin API resubmission process even if batch files already exist under given output file pattern.");
 
-   return parser.parse_args();
+   options, args = parser.parse_args();
+
+   # optparse leaves overridden values as strings.
+   options.batch = int(options.batch);
+   options.jobs = int(options.jobs);
+
+   return options, args;
 
 
 # log()
 # Presents textual messages to standard i/o, but also writes them to a log file.
 # 
 #
-def log(log_handler, text): 
+def log(log_handler, text):
    print (text);
-   log_handler.write(text + '\n');
+   if log_handler:
+      log_handler.write(text + '\n');
    return text;
 
 
@@ -115,78 +138,342 @@ def get_metadata(log_handler, metadata_file, options):
       sys.exit();
 
    if metadata_file[-4:].lower() == '.csv':
-      metadata = pd.read_csv(metadata_file, encoding = 'unicode_escape');
+      separator = ',';
 
    elif metadata_file[-4:].lower() == '.tsv':
-      metadata = pd.read_table(metadata_file, delimiter='\t', encoding = 'unicode_escape');
+      separator = '\t';
 
    else:
       log(log_handler, "A sample contextual .tsv or .csv file is required.")
       sys.exit(1);
 
+   # Cells are kept as strings: dtype=str skips pandas' per-column type
+   # inference and na_filter=False skips per-cell NA scanning, neither of
+   # which matter since rows are only matched by id and re-serialized.
+   metadata = pd.read_csv(metadata_file, sep=separator, dtype=str, engine='c',
+      na_filter=False, encoding = 'unicode_escape');
+
    # Check if given fasta record identifier is a sample metadata file column
    if not options.key_field in metadata.columns:
       log(log_handler, 'The key field column you provided [' + options.key_field + '] was not found in the contextual data file\'s list of columns:');
       log(log_handler, metadata.columns);
       sys.exit(1);
 
-   metadata.sort_values(by = options.key_field);
+   # Index rows by key field so each batch lookup is a hash/label lookup
+   # rather than a linear scan of the whole table.  Note the previous
+   # sort_values() result was discarded; sort_index() actually sorts.
+   metadata = metadata.set_index(options.key_field, drop=False).sort_index();
 
    return metadata;
 
 
+# get_metadata_index()
+# Builds a one-time record id -> row position lookup so each batch can gather
+# its metadata rows with a positional take() instead of going through the
+# pandas indexing engine per batch.
+#
+# Duplicate key field values collapse to their last row, so they are counted
+# and warned about rather than silently dropped.
+#
+# @param Object log_handler for saving progress and error text
+# @param List metadata list containing all fasta contextual data records
+# @param Dict options command line parameters by name
+# @return Dict of record id to integer row position
+#
+def get_metadata_index(log_handler, metadata, options):
+
+   id_to_pos = {};
+   duplicates = 0;
+
+   for position, record_id in enumerate(metadata[options.key_field].values):
+      if record_id in id_to_pos:
+         duplicates += 1;
+      id_to_pos[record_id] = position;
+
+   if duplicates > 0:
+      log(log_handler, 'Warning: the contextual data has ' + str(duplicates) +
+         ' row(s) repeating an earlier [' + options.key_field + '] value; only the last row of each repeated id is batched.');
+
+   return id_to_pos;
+
+
 # get_fasta_data()
-# Creates sorted list (array) of fasta records.
+# Creates sorted list (array) of fasta record pointers.
+#
+# Rather than materializing a record object for every fasta entry, the file is
+# scanned once in binary mode and only (id, offset, length) tuples pointing at
+# the raw record bytes are kept.  Batches are later written by copying those
+# byte ranges verbatim, so peak memory stays proportional to the number of
+# record ids rather than the file size.
+#
+# A sidecar [fasta_file].idx file caches the sorted index between runs, keyed
+# on the fasta file's (mtime, size) so edits invalidate it automatically.
 #
 # @param Object log_handler for saving progress and error text
+# @param String fasta_file path of fasta file to index
 # @param Dict options command line parameters by name
+# @param Boolean use_index whether to consult the sidecar index cache
+# @return List of (record id, byte offset, byte length) tuples sorted by id
 #
-def get_fasta_data(log_handler, fasta_file, options):
+def get_fasta_data(log_handler, fasta_file, options, use_index=False):
+
+   if use_index:
+      index_file = fasta_file + '.idx';
+      file_stat = os.stat(fasta_file);
+
+      if os.path.exists(index_file):
+         # A truncated or foreign sidecar just triggers a rescan rather than
+         # aborting every subsequent run.
+         try:
+            with open(index_file, 'rb') as index_handle:
+               (stat_key, fasta_data) = pickle.load(index_handle);
+         except (pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            log(log_handler, 'Ignoring unreadable fasta index ' + index_file);
+            stat_key = None;
+
+         if stat_key == (file_stat.st_mtime, file_stat.st_size):
+            log(log_handler, 'Using cached fasta index ' + index_file);
+            return fasta_data;
+
+   fasta_data = [];
+
+   # Header discovery runs as a few C-level find() sweeps over a memory map
+   # of the file, rather than a Python loop per line, so the scan is memory
+   # bandwidth bound even on multi-GB files.
+   with open(fasta_file, "rb") as fasta_handle:
+      file_size = os.fstat(fasta_handle.fileno()).st_size;
+
+      if file_size > 0:
+         fasta_map = mmap.mmap(fasta_handle.fileno(), 0, access=mmap.ACCESS_READ);
+
+         if fasta_map[:1] == b'>':
+            offset = 0;
+         else:
+            offset = fasta_map.find(b'\n>');
+            if offset >= 0:
+               offset += 1;
 
-   with open(fasta_file, "r") as fasta_handle:
-      fasta_data = SeqIO.parse(fasta_handle, "fasta");
-      # Sort Fasta file so we organize upload, and can sync with metadata
-      fasta_data = [f for f in sorted(fasta_data, key=lambda x : x.id)];
+         while offset >= 0:
+            next_offset = fasta_map.find(b'\n>', offset);
+            record_end = file_size if next_offset < 0 else next_offset + 1;
+
+            header_end = fasta_map.find(b'\n', offset);
+            if header_end < 0:
+               header_end = file_size;
+            # A bare '>' line yields an empty id, matching SeqIO's behavior.
+            header = fasta_map[offset + 1:header_end].split(None, 1);
+            record_id = header[0].decode() if header else '';
+
+            fasta_data.append((record_id, offset, record_end - offset));
+            offset = -1 if next_offset < 0 else next_offset + 1;
+
+         fasta_map.close();
+
+   # Sort Fasta records so we organize upload, and can sync with metadata.
+   # Default tuple ordering sorts by id first, so no per-record Python-level
+   # key callable is needed.
+   fasta_data.sort();
 
    return fasta_data;
 
 
+# save_fasta_index()
+# Saves the sorted record index to the sidecar [fasta_file].idx file along
+# with the fasta file's current (mtime, size) for later validation.
+#
+# @param String fasta_file path of fasta file the records were indexed from
+# @param List fasta_data list of (record id, byte offset, byte length) tuples
+#
+def save_fasta_index(fasta_file, fasta_data):
+
+   file_stat = os.stat(fasta_file);
+   index_file = fasta_file + '.idx';
+
+   # Written via a temp file so a process killed mid-write can't leave a
+   # truncated sidecar in place.
+   with open(index_file + '.tmp', 'wb') as index_handle:
+      pickle.dump(((file_stat.st_mtime, file_stat.st_size), fasta_data), index_handle);
+   os.replace(index_file + '.tmp', index_file);
+
+
+# write_fasta_records()
+# Copies the raw bytes of the given fasta records from a source fasta file to
+# an open binary output handle, avoiding any record parsing or reformatting.
+#
+# @param String fasta_file path of fasta file the records were indexed from
+# @param List fasta_data list of (record id, byte offset, byte length) tuples
+# @param Object output_handle binary file handle to write records to
+#
+def write_fasta_records(fasta_file, fasta_data, output_handle):
+
+   with open(fasta_file, "rb") as source_handle:
+      for (record_id, offset, length) in fasta_data:
+         source_handle.seek(offset);
+         record = source_handle.read(length);
+         output_handle.write(record);
+
+         # A file's last record may lack a final newline; add one so records
+         # reordered after it don't run together.
+         if not record.endswith(b'\n'):
+            output_handle.write(b'\n');
+
+
+# get_output_files()
+# Lists existing [options.output_file].* files via a single directory scan,
+# rather than one full glob (directory listing + fnmatch) per pattern needed.
+# Callers filter the returned paths by suffix.
+#
+# @param Dict options command line parameters by name
+# @return List of paths of files matching the output file prefix
+#
+def get_output_files(options):
+
+   folder = os.path.dirname(options.output_file) or '.';
+   prefix = os.path.basename(options.output_file) + '.';
+
+   with os.scandir(folder) as entries:
+      return [entry.path for entry in entries
+         if entry.is_file() and entry.name.startswith(prefix)];
+
+
 # batch_fasta()
 # Creates [options.output_file].X records containing fasta and sample 
 # contextual data in batches of at most [options.batch] records each.
 #
 # @param Object log_handler for saving progress and error text
-# @param Object fasta_data SeqIO object containing all fasta records
+# @param List fasta_data list of (record id, byte offset, byte length) tuples
 # @param List metadata list containing all fasta contextual data records
 # @param Dict options command line parameters by name
 #
 def batch_fasta(log_handler, fasta_data, metadata, options):
-   
-   # Resort fasta and metadata so they have same order as split files.
-   with open(options.fasta_file, 'w') as source_handle:
-      log(log_handler, 'Sorting and resaving source fasta and tabular files');
-      SeqIO.write(fasta_data, source_handle, "fasta");
 
-      if options.metadata_file[-4:] == '.csv':
-         separator = ',';
-      else:
-         separator = "\t";
-      
-      metadata.to_csv(options.metadata_file, sep=separator, index=False);
+   # Resort fasta and metadata so they have same order as split files.
+   # Sorted records are copied byte-for-byte to a new file which then replaces
+   # the source, since the record offsets point into the original file.
+   log(log_handler, 'Sorting and resaving source fasta and tabular files');
+
+   # The rewrite appends a newline to a final record lacking one (see
+   # write_fasta_records), so account for the extra byte up front to keep
+   # the recomputed offsets below in sync.
+   file_size = os.path.getsize(options.fasta_file);
+   if file_size > 0:
+      with open(options.fasta_file, 'rb') as source_handle:
+         source_handle.seek(file_size - 1);
+         if source_handle.read(1) != b'\n':
+            for ptr, (record_id, offset, length) in enumerate(fasta_data):
+               if offset + length == file_size:
+                  fasta_data[ptr] = (record_id, offset, length + 1);
+
+   sorted_file = options.fasta_file + '.sorted';
+   with open(sorted_file, 'wb', buffering=2**20) as source_handle:
+      write_fasta_records(options.fasta_file, fasta_data, source_handle);
+   os.replace(sorted_file, options.fasta_file);
+
+   # Record offsets are now sequential within the sorted file.
+   offset = 0;
+   for ptr, (record_id, old_offset, length) in enumerate(fasta_data):
+      fasta_data[ptr] = (record_id, offset, length);
+      offset += length;
+
+   # Cache the sorted index so a rerun (e.g. after -r reset) skips the scan
+   # and sort.
+   save_fasta_index(options.fasta_file, fasta_data);
+
+   if options.metadata_file[-4:] == '.csv':
+      separator = ',';
+   else:
+      separator = "\t";
 
+   metadata.to_csv(options.metadata_file, sep=separator, index=False);
 
    # Splits into batches of options.batch (default 1000) or less records:
-   splits = len(fasta_data)/int(options.batch);
-   if splits < 1:
-      splits = 1;
+   batches_iter = (fasta_data[ptr:ptr + options.batch] for ptr in range(0, len(fasta_data), options.batch));
 
-   for count, sequences in enumerate(np.array_split(fasta_data, splits)):
-      
-      # Determine metadata rows pertinent to all sequences. They should be in same order
-      write_metadata(log_handler, sequences, metadata, count, options);
+   # One id -> row position lookup serves every batch.
+   id_to_pos = get_metadata_index(log_handler, metadata, options);
+
+   # Batches are written by a pool of worker processes so the CPU-bound CSV
+   # formatting escapes the GIL.  Workers load the metadata once each from a
+   # shared pickle instead of receiving a DataFrame copy with every task.
+   metadata_pickle = options.output_file + '.metadata.pkl';
+   with open(metadata_pickle, 'wb') as pickle_handle:
+      pickle.dump((metadata, id_to_pos), pickle_handle);
+
+   jobs = options.jobs or os.cpu_count() or 1;
 
-      with open(options.output_file + '.'+ str(count) + '.queued.fasta', 'w') as output_handle:
-         SeqIO.write(sequences, output_handle, "fasta");
+   try:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_batch_worker, initargs=(metadata_pickle,)) as executor:
+
+         tasks = [executor.submit(generate_batch, count, sequences, options)
+            for count, sequences in enumerate(batches_iter)];
+
+         # Surface any exception raised while writing a batch, and log the
+         # files each worker wrote so the log file stays complete.
+         for task in concurrent.futures.as_completed(tasks):
+            for file_name in task.result():
+               log(log_handler, 'Saving ' + file_name);
+   finally:
+      os.remove(metadata_pickle);
+
+
+# Worker process state for batch generation, set up by init_batch_worker().
+worker_metadata = None;
+worker_id_to_pos = None;
+
+
+# init_batch_worker()
+# Loads the shared metadata pickle once per worker process, rather than
+# pickling the whole DataFrame into every task submission.
+#
+# @param String metadata_pickle path of pickled (metadata, id_to_pos) pair
+#
+def init_batch_worker(metadata_pickle):
+
+   global worker_metadata, worker_id_to_pos;
+   with open(metadata_pickle, 'rb') as pickle_handle:
+      (worker_metadata, worker_id_to_pos) = pickle.load(pickle_handle);
+
+
+# generate_batch()
+# Runs in a worker process: writes one batch's fasta and contextual data
+# files using the metadata loaded by init_batch_worker().  The written file
+# names are returned for the parent process to log.
+#
+# @param Integer count batch number
+# @param List sequences list of (record id, byte offset, byte length) tuples
+# @param Dict options command line parameters by name
+# @return List of file names written
+#
+def generate_batch(count, sequences, options):
+
+   return write_batch(None, count, sequences, worker_metadata, options, worker_id_to_pos);
+
+
+# write_batch()
+# Writes one batch's fasta file and accompanying sample contextual data file.
+#
+# @param Object log_handler for saving progress and error text
+# @param Integer count batch number
+# @param List sequences list of (record id, byte offset, byte length) tuples
+# @param List metadata list containing all fasta contextual data records
+# @param Dict options command line parameters by name
+# @param Dict id_to_pos record id -> row position lookup shared across batches
+# @return List of file names written
+#
+def write_batch(log_handler, count, sequences, metadata, options, id_to_pos=None):
+
+   # Determine metadata rows pertinent to all sequences. They should be in same order
+   file_name_tsv = write_metadata(log_handler, sequences, metadata, count, options, id_to_pos=id_to_pos);
+
+   file_name_fasta = options.output_file + '.'+ str(count) + '.queued.fasta';
+
+   # A 1 MiB buffer batches up the per-record writes into few large syscalls.
+   with open(file_name_fasta, 'wb', buffering=2**20) as output_handle:
+      write_fasta_records(options.fasta_file, sequences, output_handle);
+
+   return [file_name_tsv, file_name_fasta];
 
 
 # write_metadata
@@ -194,23 +481,36 @@ def batch_fasta(log_handler, fasta_data, metadata, options):
 # see https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.to_csv.html
 #
 # @param Object log_handler for saving progress and error text
-# @param Object fasta_data SeqIO object containing all fasta records
+# @param List fasta_data list of (record id, byte offset, byte length) tuples
 # @param List metadata list containing all fasta contextual data records
-# @param String count contains batch file 
+# @param String count contains batch file
 # @param Dict options command line parameters by name
-# @param String id last parameter of tsv or csv file name, 'queued' by default 
+# @param String id last parameter of tsv or csv file name, 'queued' by default
+# @param Dict id_to_pos record id -> row position lookup, built here if absent
+# @return String file name written
 #
-def write_metadata(log_handler, fasta_data, metadata, count, options, id='queued'):
-   id_index = [record.id for record in fasta_data];
+def write_metadata(log_handler, fasta_data, metadata, count, options, id='queued', id_to_pos=None):
+   # itemgetter over map keeps the per-record extraction at the C level.
+   id_index = list(map(itemgetter(0), fasta_data));
+
+   if id_to_pos is None:
+      id_to_pos = get_metadata_index(log_handler, metadata, options);
 
-   metabatch = metadata.loc[metadata[options.key_field].isin(id_index)];
+   # Positional gather of the batch's rows; ids missing from the metadata are
+   # skipped, as the previous index intersection silently did.
+   positions = [id_to_pos[record_id] for record_id in id_index if record_id in id_to_pos];
+   metabatch = metadata.take(positions);
 
    # FOR NOW, ONLY .TSV OUTPUT for VirusSeq.
    #suffix = options.metadata_file[-4:];
    suffix = '.tsv';
 
    file_name = options.output_file + '.'+ str(count) + '.' + id + suffix;
-   log(log_handler, 'Saving ' + file_name);
+
+   # Batch generation workers pass no handler; the parent process logs the
+   # returned file name itself.
+   if log_handler:
+      log(log_handler, 'Saving ' + file_name);
 
    if suffix == '.csv':
       separator = ',';
@@ -219,9 +519,19 @@ def write_metadata(log_handler, fasta_data, metadata, count, options, id='queued
    
    # Queued file might get several related batch number job status fail items added
    if os.path.exists(file_name) and id == 'queued':
-      metabatch.to_csv(file_name, sep=separator, index=False, mode = 'a', header = False);
+      write_mode = 'ab';
+      header = False;
    else:
-      metabatch.to_csv(file_name, sep=separator, index=False);
+      write_mode = 'wb';
+      header = True;
+
+   # A pre-opened buffered binary handle skips pandas' own file-open path, and
+   # chunked serialization keeps the intermediate string buffer small.
+   with open(file_name, write_mode, buffering=2**20) as output_handle:
+      metabatch.to_csv(output_handle, sep=separator, index=False, header=header,
+         chunksize=10000, lineterminator='\n');
+
+   return file_name;
 
 
 # api_batch_job()
@@ -238,7 +548,7 @@ def api_batch_job(log_handler, options):
       sys.exit(1);
 
    # Retrieve batch files that need uploading, indicated by ".queued." in filename.
-   batches = glob.glob("./" + options.output_file + '.*.queued.fasta');
+   batches = [f for f in get_output_files(options) if f.endswith('.queued.fasta')];
 
    if len(batches) > 0:
       log(log_handler, 'Performing batch upload ...');
@@ -252,6 +562,31 @@ def api_batch_job(log_handler, options):
       log(log_handler, 'API batch file queue is empty.');
 
 
+# get_api_session()
+# Returns a requests session with a pooled HTTP adapter so one TCP/TLS
+# connection is reused across all batch calls rather than renegotiated for
+# each request.
+#
+# Connection failures and transient 5xx responses to status queries retry
+# with exponential backoff at the adapter level.  Submission posts carry a
+# streamed body that can't be replayed by the adapter, so their 5xx retry
+# loop lives in api_virusseq_job() instead.
+#
+# @return Object requests.Session configured for batch API calls
+#
+def get_api_session():
+
+   retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+      allowed_methods=frozenset(['GET']), raise_on_status=False);
+
+   session = requests.Session();
+   adapter = requests.adapters.HTTPAdapter(max_retries=retry, pool_connections=8, pool_maxsize=8);
+   session.mount('https://', adapter);
+   session.mount('http://', adapter);
+
+   return session;
+
+
 ################################## VirusSeq API ##########################
 #
 #   API Information: https://github.com/cancogen-virus-seq/docs/wiki/How-to-Submit-Data-(API)
@@ -268,10 +603,10 @@ def api_virusseq_job(log_handler, options, batches):
    if options.development:  # TEST API ENDPOINT
       API_URL = "https://muse.dev.cancogen.cancercollaboratory.org/";
    else:  # LIVE API ENDPOINT
-      API_URL = "https://muse.virusseq-dataportal.ca/";  
+      API_URL = "https://muse.virusseq-dataportal.ca/";
 
-   # TEST file parse failure: create an empty or junky .fasta and accompanying .tsv file
-   # batches = ['test.0.queued.fasta'];
+   session = get_api_session();
+   renamed = False;
 
    for filename in batches:
 
@@ -280,31 +615,61 @@ def api_virusseq_job(log_handler, options, batches):
       if (not options.batch_number or count == options.batch_number):
 
          filename_tsv = filename.replace('.queued.fasta', '.queued.tsv');
-         with open(filename, 'rb') as fasta_handle:
-            with open(filename_tsv, 'rb') as metadata_handle:
-               upload_files = [
-                  ('files', fasta_handle), 
-                  ('files', metadata_handle)
-               ];
-               log(log_handler, 'Uploading batch: ' + filename);
-               try:
-                  request = requests.post(API_URL + 'submissions', files = upload_files, headers = {'Authorization': 'Bearer ' + options.api_token});
-               except Exception as err:
-                  log(log_handler, "API Server problem (check API URL?): " + repr(err) );
-                  sys.exit(1);
+
+         # Transient server errors retry with exponential backoff before the
+         # batch is given up on.  Files are reopened per attempt since a
+         # streamed body can't be replayed.
+         for attempt in range(5):
+            with open(filename, 'rb') as fasta_handle:
+               with open(filename_tsv, 'rb') as metadata_handle:
+                  log(log_handler, 'Uploading batch: ' + filename);
+                  headers = {'Authorization': 'Bearer ' + options.api_token};
+                  try:
+                     if MultipartEncoder:
+                        # Streams the request body from disk in small chunks,
+                        # rather than reading whole batch files into memory to
+                        # size the multipart body.
+                        encoder = MultipartEncoder(fields = [
+                           ('files', (os.path.basename(filename), fasta_handle, 'application/octet-stream')),
+                           ('files', (os.path.basename(filename_tsv), metadata_handle, 'application/octet-stream'))
+                        ]);
+                        headers['Content-Type'] = encoder.content_type;
+                        request = session.post(API_URL + 'submissions', data = encoder, headers = headers);
+                     else:
+                        upload_files = [
+                           ('files', fasta_handle),
+                           ('files', metadata_handle)
+                        ];
+                        request = session.post(API_URL + 'submissions', files = upload_files, headers = headers);
+                  except Exception as err:
+                     log(log_handler, "API Server problem (check API URL?): " + repr(err) );
+                     sys.exit(1);
+
+            if request.status_code in (500, 502, 503, 504) and attempt < 4:
+               delay = 0.5 * 2 ** attempt;
+               log(log_handler, 'Server error (' + str(request.status_code) + '), retrying in ' + str(delay) + 's');
+               time.sleep(delay);
+            else:
+               break;
+
+         # Parse the response body once; every branch below reads from it.
+         try:
+            body = request.json();
+         except ValueError:
+            body = None;
 
          if request.status_code == 200:
-            result = request.json();
-            if ('submissionId' in result):
-               submission_id = result['submissionId'];
+            if body and ('submissionId' in body):
+               submission_id = body['submissionId'];
                log(log_handler, 'Batch was submitted! submissionId: ' + submission_id);
 
-               os.rename(filename, filename.replace('.queued.','.'+submission_id+'.'));
-               os.rename(filename_tsv, filename_tsv.replace('.queued.','.'+submission_id+'.'));
+               os.replace(filename, filename.replace('.queued.','.'+submission_id+'.'));
+               os.replace(filename_tsv, filename_tsv.replace('.queued.','.'+submission_id+'.'));
+               renamed = True;
 
                continue;
             else:
-               log(log_handler, result);
+               log(log_handler, str(body));
                log(log_handler, "Resolve reported error, then rerun command!");
                sys.exit(1);
 
@@ -319,13 +684,16 @@ def api_virusseq_job(log_handler, options, batches):
             log(log_handler, "API service endpoint not recognized. Check API URL:" + API_URL)
             sys.exit(1);
          
-         request_error = request.json();
-         status = request_error['status'];
-         message = request_error['message'];
+         if body is None:
+            log(log_handler, 'Error: Unable to complete batch because of status code ' + str(request.status_code) + '\n' + request.text);
+            continue;
+
+         status = body['status'];
+         message = body['message'];
 
          log(log_handler, status + ' (' + str(request.status_code) + ') ' + message);
 
-         errorInfo = request_error['errorInfo'];
+         errorInfo = body['errorInfo'];
 
          # "Bad Request" response status indicates something wrong with the input files.
          # We have json at this point.
@@ -369,12 +737,22 @@ def api_virusseq_job(log_handler, options, batches):
          log(log_handler, 'Error: Unable to complete batch because of status code ' + str(request.status_code) + '\n' + request.text);
          continue;
 
+   # One directory fsync at the end makes all the renames durable without
+   # paying a sync per batch.
+   if renamed and hasattr(os, 'O_DIRECTORY'):
+      folder_fd = os.open(os.path.dirname(options.output_file) or '.', os.O_DIRECTORY);
+      os.fsync(folder_fd);
+      os.close(folder_fd);
+
 
 def api_batch_status(log_handler, options):
    
    # Get list of batch files to get status for
-   batches = glob.glob('./' + options.output_file + '.*.*.fasta');
-   batches = sorted(batches, key=lambda n: int(n.split('.',3)[2]) ); # sort on count of file
+   batches = [f for f in get_output_files(options) if f.endswith('.fasta') and len(f.split('.')) > 3];
+   batches = sorted(batches, key=lambda n: int(n.split('.')[-3]) ); # sort on count of file
+
+   session = get_api_session();
+
    for filename in batches:
       
       # Any errors get converted into entries in the following files
@@ -397,7 +775,7 @@ def api_batch_status(log_handler, options):
 
 
             if (options.api == 'VirusSeq_Portal'):
-               api_virusseq_status(log_handler, submission_id, error_keys, options)
+               api_virusseq_status(log_handler, session, submission_id, error_keys, options)
 
          # Write out appropriate fasta and metadata for each error.
          # This causes only errors to be resubmitted - AFTER EDITING - on next run.
@@ -410,42 +788,46 @@ def api_batch_status(log_handler, options):
             filename_tsv = filename.replace('.fasta', '.tsv');
             metadata = get_metadata(log_handler, filename_tsv, options);
 
-            # A filter iterator converted to a list
-            sequences = list(filter(lambda x: x.id in error_keys, fasta_data));
+            # Select the error records from the batch file's record pointers
+            sequences = [record for record in fasta_data if record[0] in error_keys];
 
             # Several batch id jobs can contribute to a single new .queued. file
             # if their own entry statuses switch from 'queued' to error
             output_fasta_file = options.output_file + '.'+ count + '.queued.fasta';
             if os.path.exists(output_fasta_file):
-                append_write = 'a' # append if already exists
+                append_write = 'ab' # append if already exists
             else:
-                append_write = 'w' # make a new file if not
+                append_write = 'wb' # make a new file if not
 
-            with open(output_fasta_file, append_write) as output_handle:
+            with open(output_fasta_file, append_write, buffering=2**20) as output_handle:
 
-               SeqIO.write(sequences, output_handle, "fasta");
+               write_fasta_records(filename, sequences, output_handle);
                write_metadata(log_handler, sequences, metadata, count, options);
-            
-            # Update job files to only include successes. Existing files are overwritten.
-            sequences = list(filter(lambda x: not x.id in error_keys, fasta_data));
-            with open(filename, 'w') as output_handle:
 
-               SeqIO.write(sequences, output_handle, "fasta");
+            # Update job files to only include successes. Existing files are
+            # overwritten, via a temp file since record offsets point into the
+            # original batch file.
+            sequences = [record for record in fasta_data if not record[0] in error_keys];
+            kept_file = filename + '.kept';
+            with open(kept_file, 'wb', buffering=2**20) as output_handle:
+
+               write_fasta_records(filename, sequences, output_handle);
                write_metadata(log_handler, sequences, metadata, count, options, submission_id);
+            os.replace(kept_file, filename);
 
 
-def api_virusseq_status(log_handler, submission_id, error_keys, options):
+def api_virusseq_status(log_handler, session, submission_id, error_keys, options):
 
    # VirusSeq "size" parameter clips off last record status unless set to batch
    # size + 1.
-   query = '?page=0&size=' + str(int(options.batch)+1) + '&sortDirection=ASC&sortField=submitterSampleId&submissionId=' + submission_id;
+   query = '?page=0&size=' + str(options.batch + 1) + '&sortDirection=ASC&sortField=submitterSampleId&submissionId=' + submission_id;
 
    if options.development:  # TEST API ENDPOINT
       API_URL = "https://muse.dev.cancogen.cancercollaboratory.org/";
    else:  # LIVE API ENDPOINT
       API_URL = "https://muse.virusseq-dataportal.ca/";  
 
-   feedback = requests.get(API_URL + 'uploads' + query, headers = {'Authorization': 'Bearer ' + options.api_token});
+   feedback = session.get(API_URL + 'uploads' + query, headers = {'Authorization': 'Bearer ' + options.api_token});
 
    if feedback.status_code == 200:
       response = feedback.json();
@@ -484,41 +866,52 @@ def api_virusseq_status(log_handler, submission_id, error_keys, options):
 
 ################################## The Program ##########################
 
-options, args = init_parser(); 
+# The __main__ guard keeps batch generation worker processes, which re-import
+# this module, from rerunning the program themselves.
+if __name__ == '__main__':
 
-# Program operates within log file handler that closes on exit.
-simple_date = datetime.now().isoformat().replace(':','').split('.')[0];
-with open(options.output_file + '_' + simple_date + '.log', 'w') as log_handler:
+   options, args = init_parser();
 
-   # Caution: Big file data loaded into memory
-   fasta_data = get_fasta_data(log_handler, options.fasta_file, options);
-   metadata = get_metadata(log_handler, options.metadata_file, options);
+   # Program operates within log file handler that closes on exit.
+   simple_date = datetime.now().isoformat().replace(':','').split('.')[0];
+   with open(options.output_file + '_' + simple_date + '.log', 'w') as log_handler:
 
-   log(log_handler, "Log date: " + datetime.now().isoformat() );
+      log(log_handler, "Log date: " + datetime.now().isoformat() );
 
-   # If force, clear out all existing batch files and start fresh
-   if options.reset:
-      # Add syntax check / security on options.output_file references?
-      for filename in glob.glob("./" + options.output_file + '.*'):
-         os.remove(filename);
+      # One directory scan covers both the reset cleanup and the batch file check.
+      output_files = get_output_files(options);
 
-   # STEP 1: GENERATE BATCH FILES
-   # The existence of options.output_file + .*.*.fasta files present
-   # indicates an ongoing job th
-   batches = glob.glob("./" + options.output_file + '.0.*.fasta');
-   if len(batches) > 0:
-      log(log_handler, 'Skipping batch file generation because batch files exist.');
-   else:
-      log(log_handler, 'Generating batch file(s) ...' );
-      batch_fasta(log_handler, fasta_data, metadata, options);
+      # If force, clear out all existing batch files and start fresh
+      if options.reset:
+         # Add syntax check / security on options.output_file references?
+         for filename in output_files:
+            os.remove(filename);
+         output_files = [];
+
+      # STEP 1: GENERATE BATCH FILES
+      # The existence of options.output_file + .*.*.fasta files present
+      # indicates an ongoing job th
+      batches = [f for f in output_files if f.endswith('.fasta') and f.split('.')[-3:-2] == ['0']];
+      if len(batches) > 0:
+         log(log_handler, 'Skipping batch file generation because batch files exist.');
+      else:
+         log(log_handler, 'Generating batch file(s) ...' );
+
+         # Source files are only read when batches actually need generating, so
+         # reruns that resume an upload skip the parse entirely.
+         # Caution: Big file data loaded into memory
+         fasta_data = get_fasta_data(log_handler, options.fasta_file, options, use_index=True);
+         metadata = get_metadata(log_handler, options.metadata_file, options);
+
+         batch_fasta(log_handler, fasta_data, metadata, options);
 
-   if options.api:
+      if options.api:
 
-      # STEP 2: SUBMIT the *.queued.* files TO API
-      api_batch_job(log_handler, options);
+         # STEP 2: SUBMIT the *.queued.* files TO API
+         api_batch_job(log_handler, options);
 
-      # STEP 3: Report on progress of each batch job that has been submitted.
-      # Any previous error reports for a given batch job are prepared into a
-      # new .queued.fasta and .queued.tsv file for editing and resubmission.
-      api_batch_status(log_handler, options);
+         # STEP 3: Report on progress of each batch job that has been submitted.
+         # Any previous error reports for a given batch job are prepared into a
+         # new .queued.fasta and .queued.tsv file for editing and resubmission.
+         api_batch_status(log_handler, options);
 